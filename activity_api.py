@@ -1,50 +1,459 @@
 from flask import Flask, request, jsonify
-from pymongo import MongoClient
+from flask.json.provider import JSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
+from pymongo import MongoClient, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError
+import bson
+from bson.errors import InvalidDocument
 from decouple import config
-from datetime import datetime
+from datetime import datetime, timezone
 import os
+import logging
+import atexit
+import queue
+import hashlib
+import hmac
+import threading
+import time
+import orjson
+import msgspec
+from cachetools import TTLCache
+from typing import Annotated, Any, Optional, Union
+from collections import Counter
 from functools import wraps
 
+logging.basicConfig(format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
+logger = logging.getLogger('royalguard')
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# orjson-backed JSON for jsonify and request parsing
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Request payload schemas; each body is decoded and validated in one pass.
+# strict=False keeps accepting numeric strings (e.g. "123") for integer ids,
+# so every number is also bounded: ids to what BSON can store as int64, and
+# minutes to a range that rules out the "nan"/"inf" strings lax mode accepts.
+INT64_MIN = -2**63
+INT64_MAX = 2**63 - 1
+MAX_ACTIVITY_MINUTES = 24 * 60
+
+Int64 = Annotated[int, msgspec.Meta(ge=INT64_MIN, le=INT64_MAX)]
+ActivityMinutes = msgspec.Meta(ge=0, le=MAX_ACTIVITY_MINUTES)
+
+class ActivityUpdate(msgspec.Struct):
+    user_id: Int64
+    activity_minutes: Union[Annotated[int, ActivityMinutes], Annotated[float, ActivityMinutes]]
+    api_key: Optional[str] = None
+
+class LogEvent(msgspec.Struct):
+    log_type: str
+    log_data: dict
+    timestamp: Any = None
+    api_key: Optional[str] = None
+
+class LicenseIssue(msgspec.Struct):
+    user_id: Int64
+    issued_by: Int64
+
+activity_update_decoder = msgspec.json.Decoder(ActivityUpdate, strict=False)
+log_event_decoder = msgspec.json.Decoder(LogEvent, strict=False)
+license_issue_decoder = msgspec.json.Decoder(LicenseIssue, strict=False)
+
+# Cap request bodies so parsing work stays bounded
+MAX_BODY_SIZE = 64 * 1024
+
+def decode_body(decoder):
+    # Returns the decoded payload, or None if the body is missing, malformed or invalid.
+    # At most MAX_BODY_SIZE bytes are read, so chunked bodies without a
+    # Content-Length are bounded too.
+    body = request.stream.read(MAX_BODY_SIZE + 1)
+    if len(body) > MAX_BODY_SIZE:
+        raise RequestEntityTooLarge()
+    try:
+        return decoder.decode(body)
+    except msgspec.DecodeError:
+        return None
+
+def parse_user_id_arg():
+    # Returns (user_id, None) or (None, error response) for the user_id query parameter
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return None, (jsonify({'status': 'error', 'message': 'user_id parameter required'}), 400)
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        user_id = None
+    if user_id is None or not INT64_MIN <= user_id <= INT64_MAX:
+        return None, (jsonify({'status': 'error', 'message': 'Invalid user_id format'}), 400)
+    return user_id, None
 
 # Configuration with fallbacks for Railway
 try:
     MONGO_URI = config('MONGO_URI')
     API_KEY = config('API_KEY')
 except Exception as e:
-    print(f"Configuration error: {e}")
+    logger.warning("Configuration error: %s", e)
     # Fallback values for Railway deployment
     MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017')
     API_KEY = os.environ.get('API_KEY', 'ROYALGUARDAPIKEY-1223424PRODREADY2323784237283487')
 
+# Encoded once so key checks don't re-encode on every request
+API_KEY_BYTES = API_KEY.encode()
+
+def is_valid_api_key(api_key):
+    # Constant-time comparison so response time doesn't leak the key prefix
+    if not api_key or not isinstance(api_key, str):
+        return False
+    return hmac.compare_digest(api_key.encode(), API_KEY_BYTES)
+
+# Connection pool sizing; MONGO_MIN_POOL_SIZE defaults to 0 so small
+# single-worker instances don't hold idle connections they never use
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 200))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+
 # MongoDB setup with error handling
-try:
-    client = MongoClient(MONGO_URI)
-    db = client.royalguard
-    activity_collection = db.activity
-    print("MongoDB connection established successfully")
-except Exception as e:
-    print(f"MongoDB connection failed: {e}")
-    client = None
-    db = None
-    activity_collection = None
+# The client is created lazily per process: gunicorn forks workers after
+# import, and a MongoClient inherited across fork can't safely reuse its sockets
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def _reset_client():
+    global _client, _client_pid
+    _client = None
+    _client_pid = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client)
+
+def get_client():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            try:
+                _client = MongoClient(
+                    MONGO_URI,
+                    maxPoolSize=MONGO_MAX_POOL_SIZE,
+                    minPoolSize=MONGO_MIN_POOL_SIZE,
+                    maxIdleTimeMS=300_000,
+                    serverSelectionTimeoutMS=3000,
+                    socketTimeoutMS=10_000,
+                    connectTimeoutMS=5000
+                )
+                _client_pid = pid
+                logger.info("MongoDB connection established successfully (pid %s)", pid)
+                ensure_indexes(_client.royalguard)
+            except Exception as e:
+                logger.error("MongoDB connection failed: %s", e)
+                _reset_client()
+    return _client
+
+def ensure_indexes(db):
+    # roblox_logs dedup is keyed on _id (the log hash), so it needs no extra
+    # index; this one serves the Discord bot's scan for unprocessed logs
+    try:
+        db.roblox_logs.create_index(
+            [('processed', 1), ('created_at', 1)],
+            name='unprocessed_scan'
+        )
+    except Exception as e:
+        logger.warning("Index creation failed: %s", e)
+
+def get_db():
+    client = get_client()
+    return client.royalguard if client is not None else None
+
+# Activity increments are telemetry: losing an occasional minute is acceptable,
+# so they're written unacknowledged (w=0) and don't wait on the primary.
+# Licenses and logs keep the client's acknowledged default.
+UNACKNOWLEDGED = WriteConcern(w=0)
+
+# Built once per client rather than per call; rebuilt when get_client() replaces the client
+_activity_writer = None
+_activity_writer_client = None
+
+def get_activity_writer():
+    global _activity_writer, _activity_writer_client
+    client = get_client()
+    if client is None:
+        return None
+    if _activity_writer_client is not client:
+        _activity_writer = client.royalguard.activity.with_options(write_concern=UNACKNOWLEDGED)
+        _activity_writer_client = client
+    return _activity_writer
+
+# Log batching: /log_event queues entries and a background thread in each
+# worker flushes them with insert_many, so a burst of logs costs one round-trip
+# per batch. Logs reach the Discord bot up to LOG_FLUSH_INTERVAL later.
+# Set LOG_BATCHING=false to write each log synchronously instead.
+LOG_BATCHING = os.environ.get('LOG_BATCHING', 'true').lower() == 'true'
+LOG_QUEUE_SIZE = 10_000
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 0.25
+# The client already got a 202, so writes that fail on a connection problem
+# are requeued rather than dropped; LOG_MAX_ATTEMPTS flushes spaced
+# LOG_RETRY_DELAY apart ride out a brief outage or failover before a log is
+# given up on. Other failures won't succeed on retry and are dropped at once.
+LOG_MAX_ATTEMPTS = 10
+LOG_RETRY_DELAY = 2.0
+
+_log_queue = None
+_log_queue_pid = None
+_log_queue_lock = threading.Lock()
+
+def _drop_logs(log_entries, reason):
+    logger.error("Flushing logs: dropped %d logs (%s)", len(log_entries), reason)
+    # Never stored, so a client retry must not be answered as a duplicate
+    for log_entry in log_entries:
+        forget_log_hash(log_entry['_id'])
+
+def _requeue_logs(items):
+    # Items are (log_entry, attempts) pairs
+    dropped = []
+    for log_entry, attempts in items:
+        if attempts + 1 >= LOG_MAX_ATTEMPTS:
+            dropped.append(log_entry)
+            continue
+        try:
+            _log_queue.put_nowait((log_entry, attempts + 1))
+        except queue.Full:
+            dropped.append(log_entry)
+    if dropped:
+        _drop_logs(dropped, 'repeated failures')
+
+def _flush_logs(items):
+    # Returns False if any log was requeued, so the flusher backs off
+    db = get_db()
+    if db is None:
+        logger.error("Flushing logs failed: database not available")
+        _requeue_logs(items)
+        return False
+    try:
+        db.roblox_logs.insert_many([log_entry for log_entry, _ in items], ordered=False)
+    except BulkWriteError as e:
+        # Duplicate key (11000) just means the log was already stored
+        errors = [err for err in e.details.get('writeErrors', []) if err.get('code') != 11000]
+        if errors:
+            # Per-document write errors are rejections of that document, not outages
+            _drop_logs([items[err['index']][0] for err in errors], f"write error: {errors[0].get('errmsg')}")
+    except ConnectionFailure as e:
+        # Nothing tells us which inserts landed; retried ones that did are
+        # absorbed as duplicate keys on the next flush
+        logger.error("Flushing logs failed: %s", e)
+        _requeue_logs(items)
+        return False
+    except Exception as e:
+        _drop_logs([log_entry for log_entry, _ in items], f"unexpected error: {e}")
+    return True
+
+def _drain_log_queue(log_queue):
+    items = []
+    while len(items) < LOG_BATCH_SIZE:
+        try:
+            items.append(log_queue.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+def _log_flusher(log_queue):
+    while True:
+        try:
+            first = log_queue.get(timeout=LOG_FLUSH_INTERVAL)
+        except queue.Empty:
+            continue
+        if not _flush_logs([first] + _drain_log_queue(log_queue)):
+            time.sleep(LOG_RETRY_DELAY)
+
+def get_log_queue():
+    # Threads don't survive fork, so each worker starts its own flusher
+    global _log_queue, _log_queue_pid
+    pid = os.getpid()
+    if _log_queue is not None and _log_queue_pid == pid:
+        return _log_queue
+    with _log_queue_lock:
+        if _log_queue is None or _log_queue_pid != pid:
+            log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+            threading.Thread(target=_log_flusher, args=(log_queue,), name='log-flusher', daemon=True).start()
+            _log_queue = log_queue
+            _log_queue_pid = pid
+    return _log_queue
+
+@atexit.register
+def _flush_pending_logs():
+    if _log_queue is None or _log_queue_pid != os.getpid():
+        return
+    items = _drain_log_queue(_log_queue)
+    while items:
+        _flush_logs(items)
+        items = _drain_log_queue(_log_queue)
+
+# Activity batching: /update_activity adds minutes to an in-process Counter and
+# a background thread in each worker flushes the per-user totals every
+# ACTIVITY_FLUSH_INTERVAL with one bulk_write, so repeated ticks from the same
+# player collapse into a single $inc. Set ACTIVITY_BATCHING=false to write
+# each update synchronously instead.
+ACTIVITY_BATCHING = os.environ.get('ACTIVITY_BATCHING', 'true').lower() == 'true'
+ACTIVITY_FLUSH_INTERVAL = 0.5
+
+_pending_activity = Counter()
+_pending_activity_lock = threading.Lock()
+_activity_flusher_pid = None
+_activity_flusher_lock = threading.Lock()
+
+def _take_pending_activity():
+    global _pending_activity
+    with _pending_activity_lock:
+        snapshot = _pending_activity
+        _pending_activity = Counter()
+    return snapshot
+
+def _requeue_activity(snapshot):
+    with _pending_activity_lock:
+        _pending_activity.update(snapshot)
+
+def _flush_activity():
+    snapshot = _take_pending_activity()
+    if not snapshot:
+        return
+    activity_collection = get_activity_writer()
+    if activity_collection is None:
+        _requeue_activity(snapshot)
+        return
+    try:
+        activity_collection.bulk_write(
+            [UpdateOne({'_id': user_id}, {'$inc': {'total_activity': minutes}}, upsert=True)
+             for user_id, minutes in snapshot.items()],
+            ordered=False
+        )
+    except ConnectionFailure as e:
+        # Keep the minutes for the next flush rather than losing them; with w=0
+        # only client-side failures (e.g. no reachable server) land here
+        logger.error("Flushing activity failed: %s", e)
+        _requeue_activity(snapshot)
+    except Exception as e:
+        # Anything else (e.g. a value BSON can't encode) would fail again on
+        # every retry and hold back every other user's minutes with it
+        logger.error("Flushing activity failed, dropped %d users' minutes: %s", len(snapshot), e)
+
+def _activity_flusher():
+    while True:
+        time.sleep(ACTIVITY_FLUSH_INTERVAL)
+        _flush_activity()
+
+def ensure_activity_flusher():
+    # Threads don't survive fork, so each worker starts its own flusher
+    global _activity_flusher_pid
+    pid = os.getpid()
+    if _activity_flusher_pid == pid:
+        return
+    with _activity_flusher_lock:
+        if _activity_flusher_pid != pid:
+            threading.Thread(target=_activity_flusher, name='activity-flusher', daemon=True).start()
+            _activity_flusher_pid = pid
+
+@atexit.register
+def _flush_pending_activity():
+    if _activity_flusher_pid == os.getpid():
+        _flush_activity()
+
+# Log hashes seen recently by this worker, so repeated logs are answered without
+# touching MongoDB. Per-worker only; the _id unique index remains the source of truth.
+# A hash stays cached while its log is queued or being retried, and is evicted
+# if the write is given up on.
+_recent_log_hashes = TTLCache(maxsize=10_000, ttl=300)
+_recent_log_hashes_lock = threading.Lock()
+
+def seen_recently(log_hash):
+    # Records the hash and reports whether it was already present
+    with _recent_log_hashes_lock:
+        if log_hash in _recent_log_hashes:
+            return True
+        _recent_log_hashes[log_hash] = True
+        return False
+
+def forget_log_hash(log_hash):
+    with _recent_log_hashes_lock:
+        _recent_log_hashes.pop(log_hash, None)
+
+# User ids recently confirmed to have no license, so bots polling the same users
+# don't hit MongoDB each time. Only negative results are cached, and issuing a
+# license invalidates locally; other workers may report a new license up to the
+# TTL late. A GET only caches its miss if no license was issued in this worker
+# while its lookup was in flight, so a concurrent POST can't be masked.
+_no_license_cache = TTLCache(maxsize=50_000, ttl=30)
+_no_license_cache_lock = threading.Lock()
+_license_issue_count = 0
+
+def known_unlicensed(user_id):
+    # Returns (cached, issue count to pass to mark_unlicensed)
+    with _no_license_cache_lock:
+        return user_id in _no_license_cache, _license_issue_count
+
+def mark_unlicensed(user_id, issue_count):
+    with _no_license_cache_lock:
+        if _license_issue_count == issue_count:
+            _no_license_cache[user_id] = True
+
+def forget_unlicensed(user_id):
+    global _license_issue_count
+    with _no_license_cache_lock:
+        _license_issue_count += 1
+        _no_license_cache.pop(user_id, None)
 
 # API Key authentication decorator
 def require_api_key(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         api_key = request.headers.get('X-API-Key')
-        if not api_key or api_key != API_KEY:
+        if not is_valid_api_key(api_key):
             return jsonify({'status': 'error', 'message': 'Invalid or missing API key'}), 401
         return f(*args, **kwargs)
     return decorated_function
 
+# Health checks read the topology PyMongo's background monitor already keeps
+# up to date, cached briefly so frequent probes never cost a database round-trip
+HEALTH_CHECK_TTL = 30
+_health_last_check = None
+_health_last_ok = False
+
+def database_connected():
+    global _health_last_check, _health_last_ok
+    now = time.monotonic()
+    if _health_last_check is None or now - _health_last_check > HEALTH_CHECK_TTL:
+        client = get_client()
+        _health_last_ok = client is not None and bool(client.nodes)
+        _health_last_check = now
+    return _health_last_ok
+
+# Reject oversized bodies on the Roblox-facing write endpoints up front when
+# Content-Length declares them; decode_body bounds the rest
+BODY_LIMITED_ENDPOINTS = {'update_activity', 'log_event'}
+
+@app.before_request
+def limit_body_size():
+    if request.endpoint in BODY_LIMITED_ENDPOINTS and (request.content_length or 0) > MAX_BODY_SIZE:
+        raise RequestEntityTooLarge()
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({'status': 'error', 'message': 'Request body too large'}), 413
+
 @app.route('/')
 def health_check():
     try:
         # Test MongoDB connection
-        if activity_collection is not None:
-            activity_collection.find_one()
+        if database_connected():
             db_status = "connected"
         else:
             db_status = "disconnected"
@@ -64,25 +473,34 @@ def health_check():
 
 @app.route('/update_activity', methods=['POST'])
 def update_activity():
-    data = request.get_json()
-    if not data or 'user_id' not in data or 'activity_minutes' not in data:
+    # A header key is checked before the body is read, so bad keys are rejected without parsing
+    api_key_from_header = request.headers.get('X-API-Key')
+    if api_key_from_header and not is_valid_api_key(api_key_from_header):
+        return jsonify({'status': 'error', 'message': 'Invalid or missing API key'}), 401
+
+    data = decode_body(activity_update_decoder)
+    if data is None:
         return jsonify({'status': 'error', 'message': 'Invalid data'}), 400
 
-    # Check API key from request body (for Roblox compatibility)
-    api_key_from_body = data.get('api_key')
-    api_key_from_header = request.headers.get('X-API-Key')
-    
-    # Debug logging
-    print(f"API Key from body: {api_key_from_body}")
-    print(f"API Key from header: {api_key_from_header}")
-    print(f"Expected API Key: {API_KEY}")
+    # Debug logging (never log the key itself)
+    logger.debug("API key provided in body: %s, in header: %s", bool(data.api_key), bool(api_key_from_header))
     
-    if not (api_key_from_body == API_KEY or api_key_from_header == API_KEY):
+    # Without a (non-empty) header, check API key from request body (for Roblox compatibility)
+    if not api_key_from_header and not is_valid_api_key(data.api_key):
         return jsonify({'status': 'error', 'message': 'Invalid or missing API key'}), 401
 
-    user_id = data['user_id']
-    activity_minutes = data['activity_minutes']
+    user_id = data.user_id
+    activity_minutes = data.activity_minutes
 
+    if ACTIVITY_BATCHING:
+        if get_db() is None:
+            return jsonify({'status': 'error', 'message': 'Database not available'}), 503
+        ensure_activity_flusher()
+        with _pending_activity_lock:
+            _pending_activity[user_id] += activity_minutes
+        return jsonify({'status': 'success'}), 202
+    
+    activity_collection = get_activity_writer()
     if activity_collection is None:
         return jsonify({'status': 'error', 'message': 'Database not available'}), 503
     
@@ -99,55 +517,95 @@ def update_activity():
 @app.route('/log_event', methods=['POST'])
 def log_event():
     try:
-        # Get API key from headers or request body
-        api_key = request.headers.get('X-API-Key') or request.json.get('api_key')
+        # Get API key from headers or request body; the body is only parsed
+        # once a supplied header key has been accepted
+        api_key = request.headers.get('X-API-Key')
+        if api_key and not is_valid_api_key(api_key):
+            logger.debug("Invalid API key provided for log_event")
+            return jsonify({'error': 'Invalid API key'}), 401
         
-        if not api_key or api_key != API_KEY:
-            print(f"DEBUG: Invalid API key provided: {api_key}")
+        data = decode_body(log_event_decoder)
+        if not api_key and (data is None or not is_valid_api_key(data.api_key)):
+            logger.debug("Invalid API key provided for log_event")
             return jsonify({'error': 'Invalid API key'}), 401
         
-        data = request.json
-        log_type = data.get('log_type')
-        log_data = data.get('log_data')
-        timestamp = data.get('timestamp')
+        if data is None:
+            return jsonify({'error': 'Missing log_type or log_data'}), 400
+        
+        log_type = data.log_type
+        log_data = data.log_data
+        timestamp = data.timestamp
         
         if not log_type or not log_data:
             return jsonify({'error': 'Missing log_type or log_data'}), 400
         
+        db = get_db()
+        if db is None:
+            return jsonify({'error': 'Database not available'}), 503
+        
         # Create unique hash for deduplication (exclude timestamp for better deduplication)
-        import hashlib
-        log_hash = hashlib.md5(f"{log_type}_{log_data.get('player_name', '')}_{log_data.get('message', '')}".encode()).hexdigest()
+        # Fields are joined with the ASCII unit separator so values can't run into each other
+        log_key = '\x1f'.join([str(log_type), str(log_data.get('player_name', '')), str(log_data.get('message', ''))])
+        log_hash = hashlib.blake2b(log_key.encode(), digest_size=16).hexdigest()
         
         # Store log in database for Discord bot to process
         log_entry = {
-            '_id': log_hash,  # Use hash as unique ID
             'log_type': log_type,
             'log_data': log_data,
             'timestamp': timestamp,
             'processed': False,
-            'created_at': datetime.utcnow()
+            'created_at': datetime.now(timezone.utc)
         }
         
+        # Reject logs BSON can't encode (e.g. integers beyond 64 bits) now; once
+        # queued, one bad entry would fail the whole insert_many batch
         try:
-            db.roblox_logs.insert_one(log_entry)
-        except Exception as e:
-            if "duplicate key" in str(e).lower():
-                print(f"DEBUG: Duplicate log ignored for {log_type} - {log_data.get('username', 'unknown')}")
-                return jsonify({'success': True, 'message': 'Duplicate log ignored'})
-            else:
-                raise e
-        print(f"DEBUG: Stored {log_type} log for processing")
+            bson.encode(log_entry)
+        except (InvalidDocument, OverflowError):
+            return jsonify({'error': 'log_data cannot be stored'}), 400
+        
+        if seen_recently(log_hash):
+            logger.debug("Duplicate log ignored for %s - %s (cached)", log_type, log_data.get('username', 'unknown'))
+            return jsonify({'success': True, 'message': 'Duplicate log ignored'})
+        
+        if LOG_BATCHING:
+            try:
+                get_log_queue().put_nowait(({'_id': log_hash, **log_entry}, 0))
+                logger.debug("Queued %s log for processing", log_type)
+                return jsonify({'success': True, 'message': 'Log queued for processing'}), 202
+            except queue.Full:
+                # Flusher is behind; write this one directly rather than drop it
+                pass
+        
+        # Single upsert on the hash: inserts new logs and leaves duplicates untouched
+        try:
+            result = db.roblox_logs.update_one(
+                {'_id': log_hash},  # Use hash as unique ID
+                {'$setOnInsert': log_entry},
+                upsert=True
+            )
+        except Exception:
+            # Not stored, so a retry of this log must not be treated as a duplicate
+            forget_log_hash(log_hash)
+            raise
+        if result.upserted_id is None:
+            logger.debug("Duplicate log ignored for %s - %s", log_type, log_data.get('username', 'unknown'))
+            return jsonify({'success': True, 'message': 'Duplicate log ignored'})
+        logger.debug("Stored %s log for processing", log_type)
         
         return jsonify({'success': True, 'message': 'Log stored for processing'})
     
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"ERROR in log_event: {str(e)}")
+        logger.error("Error in log_event: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/license', methods=['GET', 'POST', 'DELETE'])
 @require_api_key
 def license():
     try:
+        db = get_db()
         if db is None:
             return jsonify({'status': 'error', 'message': 'Database not available'}), 503
         
@@ -155,16 +613,21 @@ def license():
         
         if request.method == 'GET':
             # Get license info
-            user_id = request.args.get('user_id')
-            if not user_id:
-                return jsonify({'status': 'error', 'message': 'user_id parameter required'}), 400
+            user_id, error = parse_user_id_arg()
+            if error:
+                return error
             
-            try:
-                user_id = int(user_id)
-            except ValueError:
-                return jsonify({'status': 'error', 'message': 'Invalid user_id format'}), 400
+            cached, issue_count = known_unlicensed(user_id)
+            if cached:
+                return jsonify({
+                    'status': 'success',
+                    'has_license': False
+                })
             
-            license_data = licenses_collection.find_one({'_id': user_id})
+            license_data = licenses_collection.find_one(
+                {'_id': user_id},
+                projection={'issued_by': 1, 'issued_at': 1}
+            )
             
             if license_data:
                 return jsonify({
@@ -174,6 +637,7 @@ def license():
                     'issued_at': license_data.get('issued_at')
                 })
             else:
+                mark_unlicensed(user_id, issue_count)
                 return jsonify({
                     'status': 'success',
                     'has_license': False
@@ -181,58 +645,47 @@ def license():
         
         elif request.method == 'POST':
             # Issue license
-            data = request.get_json()
-            if not data or 'user_id' not in data or 'issued_by' not in data:
-                return jsonify({'status': 'error', 'message': 'user_id and issued_by required'}), 400
-            
-            user_id = data['user_id']
-            issued_by = data['issued_by']
+            data = decode_body(license_issue_decoder)
+            if data is None:
+                return jsonify({'status': 'error', 'message': 'user_id and issued_by required as integers'}), 400
             
-            try:
-                user_id = int(user_id)
-                issued_by = int(issued_by)
-            except ValueError:
-                return jsonify({'status': 'error', 'message': 'Invalid user_id or issued_by format'}), 400
-            
-            # Check if user already has license
-            existing_license = licenses_collection.find_one({'_id': user_id})
-            if existing_license:
-                return jsonify({'status': 'error', 'message': 'User already has a license'}), 409
+            user_id = data.user_id
+            issued_by = data.issued_by
             
-            # Issue new license
+            # Issue new license; the unique _id rejects users who already have one
             license_data = {
                 '_id': user_id,
                 'issued_by': issued_by,
-                'issued_at': datetime.utcnow().isoformat()
+                'issued_at': datetime.now(timezone.utc).isoformat()
             }
             
-            licenses_collection.insert_one(license_data)
+            try:
+                licenses_collection.insert_one(license_data)
+            except DuplicateKeyError:
+                forget_unlicensed(user_id)
+                return jsonify({'status': 'error', 'message': 'User already has a license'}), 409
+            forget_unlicensed(user_id)
             return jsonify({'status': 'success', 'message': 'License issued successfully'})
         
         elif request.method == 'DELETE':
             # Revoke license
-            user_id = request.args.get('user_id')
-            if not user_id:
-                return jsonify({'status': 'error', 'message': 'user_id parameter required'}), 400
-            
-            try:
-                user_id = int(user_id)
-            except ValueError:
-                return jsonify({'status': 'error', 'message': 'Invalid user_id format'}), 400
+            user_id, error = parse_user_id_arg()
+            if error:
+                return error
             
-            # Check if user has license
-            existing_license = licenses_collection.find_one({'_id': user_id})
-            if not existing_license:
+            # Revoke license; nothing deleted means the user had none
+            result = licenses_collection.delete_one({'_id': user_id})
+            if result.deleted_count == 0:
                 return jsonify({'status': 'error', 'message': 'User does not have a license'}), 404
-            
-            # Revoke license
-            licenses_collection.delete_one({'_id': user_id})
             return jsonify({'status': 'success', 'message': 'License revoked successfully'})
     
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"ERROR in license endpoint: {str(e)}")
+        logger.error("Error in license endpoint: %s", e)
         return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
 
+# Local development only; deployments run under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
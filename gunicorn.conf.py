@@ -0,0 +1,14 @@
+import multiprocessing
+import os
+
+# Loaded automatically by gunicorn from the working directory
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Threaded workers let requests overlap while they wait on MongoDB; each
+# worker builds its own MongoClient after fork (see get_client)
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 4)))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Hold idle client connections open briefly so repeat requests skip the TCP/TLS setup
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))